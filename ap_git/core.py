@@ -1,6 +1,10 @@
+import hashlib
 import logging
+import os
 import subprocess
-from threading import RLock
+import time
+from collections import OrderedDict
+from threading import Lock, RLock
 from . import utils
 from . import exceptions as ex
 
@@ -13,6 +17,23 @@ class GitRepo:
     """
 
     __checkout_locks = dict()
+    __head_cache = dict()
+    # bounded, every build clone also lists its remotes once and is
+    # deleted afterwards
+    __remote_list_cache_size = 8
+    __remote_list_cache = OrderedDict()
+    __remote_list_cache_lock = Lock()
+    # ref lookups on remotes are reused for this many seconds, a page load
+    # resolves the same branch several times in quick succession
+    __remote_ref_cache_ttl = 60
+    __remote_ref_cache_size = 64
+    __remote_ref_cache = OrderedDict()
+    __remote_ref_cache_lock = Lock()
+    __cat_file_processes = dict()
+    __cat_file_lock = Lock()
+    # refs in a source repository keeping the commits checked out in its
+    # shared clones from being pruned
+    __shared_clone_ref_prefix = 'refs/shared-clones/'
 
     def __init__(self, local_path: str) -> None:
         """
@@ -95,6 +116,122 @@ class GitRepo:
             )
         return lock
 
+    def __rev_parse_head(self) -> str:
+        """
+        Resolve the commit ID HEAD points to using 'git rev-parse'.
+
+        Returns:
+            str: Commit ID pointed to by HEAD
+        """
+        cmd = ['git', 'rev-parse', 'HEAD']
+        logger.debug(f"Running {' '.join(cmd)}")
+        ret = subprocess.run(
+            cmd, cwd=self.__local_path, shell=False, capture_output=True,
+            encoding='utf-8', check=True
+        )
+        return ret.stdout.strip()
+
+    @staticmethod
+    def __file_key(path: str) -> tuple:
+        """
+        Return a key identifying the current version of a file.
+
+        git rewrites HEAD and refs through a lockfile rename, so the inode
+        changes along with the modification time on every update.
+
+        Parameters:
+            path (str): Path to the file
+
+        Returns:
+            tuple | None: The key, None if the file does not exist
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def __read_ref(self, git_dir: str, ref: str) -> tuple:
+        """
+        Read the commit ID of a ref from its loose ref file, or from the
+        packed-refs file if there is no loose one.
+
+        Parameters:
+            git_dir (str): Path to the .git directory
+            ref (str): Full name of the ref, e.g. refs/heads/master
+
+        Returns:
+            tuple: The commit ID, None if not found, and the files the
+                   result depends on mapped to their keys
+        """
+        loose_path = os.path.join(git_dir, ref)
+        loose_key = GitRepo.__file_key(loose_path)
+        if loose_key is not None:
+            with open(loose_path, 'r') as f:
+                return f.read().strip(), {loose_path: loose_key}
+
+        packed_path = os.path.join(git_dir, 'packed-refs')
+        deps = {
+            loose_path: None,
+            packed_path: GitRepo.__file_key(packed_path),
+        }
+        if deps[packed_path] is None:
+            return None, deps
+
+        with open(packed_path, 'r') as f:
+            for line in f:
+                # lines are "<id> <ref>", comments start with '#' and
+                # peeled tags with '^'
+                parts = line.rstrip('\n').split(' ')
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0], deps
+
+        return None, deps
+
+    def get_head_commit_id(self) -> str:
+        """
+        Return the commit ID HEAD points to.
+
+        HEAD, and the ref it points to if any, are read directly from the
+        loose ref files or packed-refs to avoid spawning a git process.
+        The result is cached until any of the files read is rewritten.
+
+        Returns:
+            str: Commit ID pointed to by HEAD
+        """
+        git_dir = os.path.join(self.__local_path, '.git')
+        if not os.path.isdir(git_dir):
+            # .git is a file, e.g. for submodules and linked worktrees
+            return self.__rev_parse_head()
+
+        cached = GitRepo.__head_cache.get(self)
+        if cached is not None and all(
+                GitRepo.__file_key(path) == key
+                for path, key in cached[0].items()):
+            return cached[1]
+
+        head_path = os.path.join(git_dir, 'HEAD')
+        deps = {head_path: GitRepo.__file_key(head_path)}
+        with open(head_path, 'r') as f:
+            head = f.read().strip()
+
+        if head.startswith('ref: '):
+            # symbolic ref, resolve it through the ref files
+            commit_id, ref_deps = self.__read_ref(
+                git_dir=git_dir, ref=head[len('ref: '):]
+            )
+            deps.update(ref_deps)
+        else:
+            # detached HEAD
+            commit_id = head
+
+        if not commit_id or not utils.is_valid_hex_string(test_str=commit_id):
+            # unborn branch or a format we do not understand
+            return self.__rev_parse_head()
+
+        GitRepo.__head_cache[self] = (deps, commit_id)
+        return commit_id
+
     def __checkout(self, commit_ref: str, force: bool = False) -> None:
         """
         Check out a specific commit.
@@ -117,7 +254,10 @@ class GitRepo:
         logger.debug(f"Running {' '.join(cmd)}")
         logger.debug("Attempting to aquire checkout lock.")
         with self.get_checkout_lock():
-            subprocess.run(cmd, cwd=self.__local_path, shell=False, check=True)
+            subprocess.run(
+                cmd, cwd=self.__local_path, shell=False, check=True,
+                stdout=utils.unused_output_target()
+            )
 
     def __reset(self, commit_ref: str, hard: bool = False) -> None:
         """
@@ -138,7 +278,10 @@ class GitRepo:
         if hard:
             cmd.append('--hard')
         logger.debug(f"Running {' '.join(cmd)}")
-        subprocess.run(cmd, cwd=self.__local_path, shell=False, check=True)
+        subprocess.run(
+            cmd, cwd=self.__local_path, shell=False, check=True,
+            stdout=utils.unused_output_target()
+        )
 
     def __force_recursive_clean(self) -> None:
         """
@@ -147,15 +290,37 @@ class GitRepo:
         """
         cmd = ['git', 'clean', '-xdff']
         logger.debug(f"Running {' '.join(cmd)}")
-        subprocess.run(cmd, cwd=self.__local_path, shell=False, check=True)
+        subprocess.run(
+            cmd, cwd=self.__local_path, shell=False, check=True,
+            stdout=utils.unused_output_target()
+        )
 
     def __remote_list(self) -> list[str]:
         """
         Retrieve a list of remotes added to the repository
 
+        The list is cached until the repository config file is rewritten,
+        as most operations check the remote before doing anything else.
+
         Returns:
             list[str]: List of remote names
         """
+        config_path = os.path.join(self.__local_path, '.git', 'config')
+        try:
+            st = os.stat(config_path)
+            # git rewrites the config through a lockfile rename
+            key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except (FileNotFoundError, NotADirectoryError):
+            # .git is a file, e.g. for submodules and linked worktrees
+            key = None
+
+        with GitRepo.__remote_list_cache_lock:
+            cached = GitRepo.__remote_list_cache.get(self)
+            if key is not None and cached is not None and cached[0] == key:
+                # mark as most recently used
+                GitRepo.__remote_list_cache.move_to_end(self)
+                return cached[1]
+
         cmd = ['git', 'remote']
 
         logger.debug(f"Running {' '.join(cmd)}")
@@ -163,7 +328,15 @@ class GitRepo:
             cmd, cwd=self.__local_path, shell=False, capture_output=True,
             encoding='utf-8', check=True
         )
-        return ret.stdout.split('\n')[:-1]
+        remotes = ret.stdout.splitlines()
+        if key is not None:
+            with GitRepo.__remote_list_cache_lock:
+                cache = GitRepo.__remote_list_cache
+                cache[self] = (key, remotes)
+                cache.move_to_end(self)
+                if len(cache) > GitRepo.__remote_list_cache_size:
+                    cache.popitem(last=False)
+        return remotes
 
     def __is_commit_present_locally(self, commit_ref: str) -> bool:
         """
@@ -178,11 +351,63 @@ class GitRepo:
         if commit_ref is None:
             raise ValueError("commit_ref is required, cannot be None.")
 
+        result = self.__cat_file_batch_check(obj=f"{commit_ref}^{{commit}}")
+        if result is not None:
+            # git reports "<id> commit <size>" for an existing commit and
+            # "<name> missing" or "<name> ambiguous" otherwise
+            return result.split(' ')[1:2] == ['commit']
+
         cmd = ['git', 'diff-tree', commit_ref, '--no-commit-id', '--no-patch']
         logger.debug(f"Running {' '.join(cmd)}")
-        ret = subprocess.run(cmd, cwd=self.__local_path, shell=False)
+        ret = subprocess.run(
+            cmd, cwd=self.__local_path, shell=False,
+            stdout=subprocess.DEVNULL
+        )
         return ret.returncode == 0
 
+    def __cat_file_batch_check(self, obj: str) -> str:
+        """
+        Look up an object through a long-running
+        'git cat-file --batch-check' process shared by the instances
+        pointing to this repository, sparing a git process per lookup.
+
+        Parameters:
+            obj (str): Name of the object to look up
+
+        Returns:
+            str | None: The line git reports for the object, None if
+                        the batch process is unusable
+        """
+        if '\n' in obj:
+            return None
+
+        with GitRepo.__cat_file_lock:
+            proc = GitRepo.__cat_file_processes.get(self)
+            try:
+                if proc is None or proc.poll() is not None:
+                    cmd = ['git', 'cat-file', '--batch-check']
+                    logger.debug(f"Running {' '.join(cmd)}")
+                    proc = subprocess.Popen(
+                        cmd, cwd=self.__local_path, shell=False,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        encoding='utf-8'
+                    )
+                    GitRepo.__cat_file_processes[self] = proc
+
+                proc.stdin.write(obj + '\n')
+                proc.stdin.flush()
+                line = proc.stdout.readline()
+            except OSError:
+                logger.exception("git cat-file batch process failed.")
+                line = ''
+
+            if not line:
+                # the process died, start a new one on the next lookup
+                GitRepo.__cat_file_processes.pop(self, None)
+                return None
+
+            return line.strip()
+
     def remote_set_url(self, remote: str, url: str) -> None:
         """
         Set the URL for a specific remote.
@@ -249,7 +474,7 @@ class GitRepo:
                                        (default is False)
             refetch (bool): Re-fetch all objects (default is False)
         """
-        cmd = ['git', 'fetch']
+        cmd = ['git', '-c', 'protocol.version=2', 'fetch']
 
         if remote:
             cmd.append(remote)
@@ -272,51 +497,10 @@ class GitRepo:
             cmd.append('--no-recurse-submodules')
 
         logger.debug(f"Running {' '.join(cmd)}")
-        subprocess.run(cmd, cwd=self.__local_path, shell=False)
-
-    def __branch_create(self, branch_name: str,
-                        start_point: str = None) -> None:
-        """
-        Create a new branch starting from a given commit.
-
-        Parameters:
-            branch_name (str): Name of the branch to create
-            start_point (str): Starting commit or branch (optional)
-        """
-        if branch_name is None:
-            raise ValueError("branch_name is required, cannot be None.")
-
-        cmd = ['git', 'branch', branch_name]
-
-        if start_point:
-            if not self.__is_commit_present_locally(commit_ref=start_point):
-                raise ex.CommitNotFoundError(commit_ref=start_point)
-            cmd.append(start_point)
-
-        logger.debug(f"Running {' '.join(cmd)}")
-        subprocess.run(cmd, cwd=self.__local_path, shell=False, check=True)
-
-    def __branch_delete(self, branch_name: str, force: bool = False) -> None:
-        """
-        Delete a local branch.
-
-        Parameters:
-            branch_name (str): Name of the branch to delete
-            force (bool): Force delete (default is False)
-        """
-        if branch_name is None:
-            raise ValueError("branch_name is required, cannot be None.")
-
-        if not self.__is_commit_present_locally(commit_ref=branch_name):
-            raise ex.CommitNotFoundError(commit_ref=branch_name)
-
-        cmd = ['git', 'branch', '-d', branch_name]
-
-        if force:
-            cmd.append('--force')
-
-        logger.debug(f"Running {' '.join(cmd)}")
-        subprocess.run(cmd, cwd=self.__local_path, shell=False, check=True)
+        subprocess.run(
+            cmd, cwd=self.__local_path, shell=False,
+            stdout=utils.unused_output_target()
+        )
 
     def commit_id_for_remote_ref(self, remote: str,
                                  commit_ref: str) -> str:
@@ -355,7 +539,19 @@ class GitRepo:
         if ref_type not in allowed_ref_types:
             raise ValueError(f"ref_type '{ref_type}' is not supported.")
 
-        cmd = ['git', 'ls-remote', remote]
+        cache_key = (self, remote, commit_ref)
+        with GitRepo.__remote_ref_cache_lock:
+            cached = GitRepo.__remote_ref_cache.get(cache_key)
+        if (cached is not None and
+                time.monotonic() - cached[0] < GitRepo.__remote_ref_cache_ttl):
+            return cached[1]
+
+        # with protocol v2 the server only advertises the refs of the
+        # requested type instead of every branch and tag it has
+        cmd = [
+            'git', '-c', 'protocol.version=2', 'ls-remote', f'--{ref_type}',
+            remote, commit_ref
+        ]
 
         logger.debug(f"Running {' '.join(cmd)}")
         ret = subprocess.run(
@@ -363,13 +559,36 @@ class GitRepo:
             shell=False, check=True
         )
 
-        for line in ret.stdout.split('\n')[:-1]:
+        for line in ret.stdout.splitlines():
             (commit_id, res_ref) = line.split('\t')
             if res_ref == commit_ref:
+                self.__remote_ref_cache_put(cache_key, commit_id)
                 return commit_id
 
         return None
 
+    @staticmethod
+    def __remote_ref_cache_put(cache_key: tuple, commit_id: str) -> None:
+        """
+        Cache the commit ID a remote ref resolved to, dropping expired
+        entries and the oldest ones if the cache is full
+
+        Parameters:
+            cache_key (tuple): The repository, remote and ref resolved
+            commit_id (str): The commit ID the ref resolved to
+        """
+        with GitRepo.__remote_ref_cache_lock:
+            cache = GitRepo.__remote_ref_cache
+            now = time.monotonic()
+            cache.pop(cache_key, None)
+            cache[cache_key] = (now, commit_id)
+            # entries are kept in insertion order, which is also the
+            # order they expire in
+            while (len(cache) > GitRepo.__remote_ref_cache_size or
+                    now - next(iter(cache.values()))[0] >=
+                    GitRepo.__remote_ref_cache_ttl):
+                cache.popitem(last=False)
+
     def __ensure_commit_fetched(self, remote: str, commit_id: str) -> None:
         """
         Ensure a specific commit is fetched from the remote repository.
@@ -453,17 +672,28 @@ class GitRepo:
         # perform checkout on the specified commit using the commit ID
         # commit ID is used in place of branch name or tag name to make sure
         # do not check out the branch or tag from wrong remote
-        self.__checkout(commit_ref=commit_id, force=force)
+        # skip it if HEAD is already there, which is common when
+        # the boards and the build options are fetched back to back.
+        # a forced checkout without a hard reset is still needed to
+        # discard local changes
+        checked_out = False
+        if (self.get_head_commit_id() != commit_id or
+                (force and not hard_reset)):
+            self.__checkout(commit_ref=commit_id, force=force)
+            checked_out = True
 
         # optional hard reset and clean of working tree after checkout
-        if hard_reset:
+        # a forced checkout of the commit ID already leaves the index and
+        # the working tree matching it, so only reset if it was skipped
+        if hard_reset and not (checked_out and force):
             self.__reset(commit_ref=commit_id, hard=True)
 
         if clean_working_tree:
             self.__force_recursive_clean()
 
     def submodule_update(self, init: bool = False, recursive: bool = False,
-                         force: bool = False) -> None:
+                         force: bool = False, jobs: int = None,
+                         depth: int = None) -> None:
         """
         Update Git submodules for the repository.
 
@@ -473,8 +703,22 @@ class GitRepo:
             recursive (bool): Update submodules recursively (default is False)
             force (bool): Force update even if there are changes
                           (default is False)
-        """
-        cmd = ['git', 'submodule', 'update']
+            jobs (int): Number of submodules fetched and cloned in parallel
+                        (optional)
+            depth (int): Truncate the history of cloned submodules to the
+                         given number of commits (optional)
+        """
+        # the config given with -c is passed on to the clones and fetches
+        # that git runs for each submodule. when this repository borrows
+        # objects from another one, e.g. a shared clone, newly cloned
+        # submodules borrow from the matching submodules of that one and
+        # only transfer the objects it does not have
+        cmd = [
+            'git', '-c', 'protocol.version=2',
+            '-c', 'submodule.alternateLocation=superproject',
+            '-c', 'submodule.alternateErrorStrategy=info',
+            'submodule', 'update'
+        ]
 
         if init:
             cmd.append('--init')
@@ -485,8 +729,17 @@ class GitRepo:
         if force:
             cmd.append('--force')
 
+        if jobs:
+            cmd.append(f'--jobs={jobs}')
+
+        if depth:
+            cmd.append(f'--depth={depth}')
+
         logger.debug(f"Running {' '.join(cmd)}")
-        subprocess.run(cmd, cwd=self.__local_path, shell=False, check=True)
+        subprocess.run(
+            cmd, cwd=self.__local_path, shell=False, check=True,
+            stdout=utils.unused_output_target()
+        )
 
     def remote_add(self, remote: str, url: str) -> None:
         """
@@ -513,7 +766,10 @@ class GitRepo:
         # Add the new remote
         cmd = ['git', 'remote', 'add', remote, url]
         logger.debug(f"Running {' '.join(cmd)}")
-        subprocess.run(cmd, cwd=self.__local_path, shell=False, check=True)
+        subprocess.run(
+            cmd, cwd=self.__local_path, shell=False, check=True,
+            stdout=utils.unused_output_target()
+        )
 
     def remote_add_bulk(self, remotes: tuple, force: bool = False) -> None:
         """
@@ -550,7 +806,9 @@ class GitRepo:
               branch: str = None,
               single_branch: bool = False,
               recurse_submodules: bool = False,
-              shallow_submodules: bool = False) -> "GitRepo":
+              shallow_submodules: bool = False,
+              shared: bool = False,
+              no_checkout: bool = False) -> "GitRepo":
         """
         Clone a Git repository.
 
@@ -563,6 +821,11 @@ class GitRepo:
             recurse_submodules (bool): Recurse into submodules
                                        (default is False)
             shallow_submodules (bool): any cloned submodules will be shallow
+            shared (bool): Borrow the objects of a local source through
+                           alternates instead of copying them
+                           (default is False)
+            no_checkout (bool): Do not check out HEAD after cloning
+                                (default is False)
 
         Returns:
             GitRepo: the cloned git repository
@@ -581,8 +844,17 @@ class GitRepo:
         if shallow_submodules:
             cmd.append('--shallow-submodules')
 
+        if shared:
+            cmd.append('--shared')
+
+        if no_checkout:
+            cmd.append('--no-checkout')
+
         logger.debug(f"Running {' '.join(cmd)}")
-        subprocess.run(cmd, shell=False, check=True)
+        subprocess.run(
+            cmd, shell=False, check=True,
+            stdout=utils.unused_output_target()
+        )
 
         return GitRepo(local_path=dest)
 
@@ -592,7 +864,12 @@ class GitRepo:
                                            commit_ref: str,
                                            dest: str) -> "GitRepo":
         """
-        Perform a shallow clone of a repository at a specific commit.
+        Clone a local repository and check out a specific commit.
+
+        The clone shares the object database of the source repository
+        instead of copying it, so only the working tree is written.
+        The commit is kept reachable in the source repository until
+        release_shared_clone() is called for the clone.
 
         Parameters:
             source (str): Source path of the local repository
@@ -621,30 +898,83 @@ class GitRepo:
         )
         source_repo.__ensure_commit_fetched(remote=remote, commit_id=commit_id)
 
-        # create a temporary branch to point to the specified commit
-        # as shallow clone needs a branch
-        temp_branch_name = "temp-b-" + commit_id
-        source_repo.__branch_create(
-            branch_name=temp_branch_name, start_point=commit_id
+        # the clone reads its objects from the source repository, a ref
+        # there keeps a gc from pruning them if the remote branch moves
+        # while the clone is in use
+        cmd = ['git', 'update-ref', GitRepo.__shared_clone_ref(dest),
+               commit_id]
+        logger.debug(f"Running {' '.join(cmd)}")
+        subprocess.run(
+            cmd, cwd=source, shell=False, check=True,
+            stdout=utils.unused_output_target()
         )
 
-        # perform the clone from the source repository
-        # using the temporary branch
+        # every object of the source repository is reachable from the
+        # shared clone, so the commit can be checked out directly
+        # without creating a temporary branch pointing to it
         cloned_repo = GitRepo.clone(
             source=source,
             dest=dest,
-            branch=temp_branch_name,
-            single_branch=True,
-            recurse_submodules=True,
-            shallow_submodules=True
+            shared=True,
+            no_checkout=True
         )
+        cloned_repo.__checkout(commit_ref=commit_id)
 
         # add the remote containing the commit in cloned repo for reference
         url = source_repo.remote_get_url(remote=remote)
         cloned_repo.remote_add(remote=remote, url=url)
 
-        # delete the temporary branch in source repository
-        # after the clone operation
-        source_repo.__branch_delete(branch_name=temp_branch_name, force=True)
-
         return cloned_repo
+
+    @staticmethod
+    def __shared_clone_ref(dest: str) -> str:
+        """
+        Return the ref keeping the commit of a shared clone alive in
+        its source repository.
+
+        Parameters:
+            dest (str): Path of the clone
+        """
+        digest = hashlib.sha1(os.path.abspath(dest).encode()).hexdigest()
+        return GitRepo.__shared_clone_ref_prefix + digest
+
+    @staticmethod
+    def release_shared_clone(source: str, dest: str) -> None:
+        """
+        Let the commit checked out in a clone made by
+        shallow_clone_at_commit_from_local be pruned from the source
+        repository again, once the clone is not used anymore.
+
+        Parameters:
+            source (str): Path of the source repository
+            dest (str): Path of the clone
+        """
+        cmd = ['git', 'update-ref', '-d', GitRepo.__shared_clone_ref(dest)]
+        logger.debug(f"Running {' '.join(cmd)}")
+        subprocess.run(
+            cmd, cwd=source, shell=False, check=True,
+            stdout=utils.unused_output_target()
+        )
+
+    def release_all_shared_clones(self) -> None:
+        """
+        Release the commits of all shared clones of this repository,
+        e.g. at startup for clones left behind by an earlier run.
+        """
+        cmd = ['git', 'for-each-ref', '--format=delete %(refname)',
+               GitRepo.__shared_clone_ref_prefix]
+        logger.debug(f"Running {' '.join(cmd)}")
+        ret = subprocess.run(
+            cmd, cwd=self.__local_path, shell=False, capture_output=True,
+            encoding='utf-8', check=True
+        )
+        if not ret.stdout:
+            return
+
+        cmd = ['git', 'update-ref', '--stdin']
+        logger.debug(f"Running {' '.join(cmd)}")
+        subprocess.run(
+            cmd, cwd=self.__local_path, shell=False, input=ret.stdout,
+            encoding='utf-8', check=True,
+            stdout=utils.unused_output_target()
+        )
@@ -24,7 +24,9 @@ def is_git_repo(path: str) -> bool:
 
     cmd = ['git', 'rev-parse', '--is-inside-work-tree']
     logger.debug(f"Running {' '.join(cmd)}")
-    ret = subprocess.run(cmd, cwd=path, shell=False)
+    ret = subprocess.run(
+        cmd, cwd=path, shell=False, stdout=subprocess.DEVNULL
+    )
     return ret.returncode == 0
 
 
@@ -39,3 +41,15 @@ def is_valid_hex_string(test_str: str) -> bool:
         raise ValueError("test_str cannot be None")
 
     return all(c in '1234567890abcdef' for c in test_str)
+
+
+def unused_output_target():
+    """
+    Return where to send the standard output of git commands whose
+    output is not used. It is only passed through to the server's
+    output when debug logging is enabled.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        return None
+
+    return subprocess.DEVNULL
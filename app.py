@@ -5,14 +5,15 @@ import subprocess
 import json
 import pathlib
 import shutil
-import glob
 import time
 import fcntl
 import base64
+import errno
 import hashlib
-from distutils.dir_util import copy_tree
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, render_template, request, send_from_directory, render_template_string, jsonify, redirect
-from threading import Thread, Lock
+from threading import Thread, Lock, Event, local
 import sys
 import re
 import requests
@@ -55,14 +56,37 @@ basedir = os.path.abspath(cmd_opts.basedir)
 sourcedir = os.path.join(basedir, 'ardupilot')
 outdir_parent = os.path.join(basedir, 'builds')
 tmpdir_parent = os.path.join(basedir, 'tmp')
+trashdir = os.path.join(basedir, 'trash')
 
 appdir = os.path.dirname(__file__)
 
 builds_dict = {}
+status_json = None
+# when the age shown for the next build rolls over to its next minute
+next_age_change = 0
+# how far each build.log has been scanned and what was found in it
+build_log_scans = {}
+progress_regex = re.compile(rb'(\[\D*(\d+)\D*\/\D*(\d+)\D*\])')
 REMOTES = None
 
 # LOCKS
 queue_lock = Lock()
+# set when a build is queued by this process, builds queued by other
+# processes are picked up by polling
+queue_event = Event()
+
+# deletes discarded directories off the queue thread, a few trees are
+# removed at once so a batch of expired builds is freed quickly
+cleanup_executor = ThreadPoolExecutor(max_workers=4)
+
+# number of builds run at the same time, each waf build already uses
+# every CPU so only large machines run a second one
+build_workers = max(1, min(2, (os.cpu_count() or 1) // 4))
+
+# reuses connections to the firmware server across requests, one
+# session per thread as requests.Session is not documented to be
+# thread-safe
+http_local = local()
 
 try:
     repo = ap_git.GitRepo(sourcedir)
@@ -82,52 +106,109 @@ versions_fetcher = metadata_manager.VersionsFetcher(
 )
 versions_fetcher.start()
 
+def get_http_session():
+    '''return the requests session of the calling thread'''
+    session = getattr(http_local, 'session', None)
+    if session is None:
+        session = http_local.session = requests.Session()
+    return session
+
+
 def remove_directory_recursive(dirname):
     '''remove a directory recursively'''
-    app.logger.info('Removing directory ' + dirname)
-    if not os.path.exists(dirname):
+    app.logger.info('Removing directory %s', dirname)
+    try:
+        shutil.rmtree(dirname)
+    except FileNotFoundError:
         return
-    f = pathlib.Path(dirname)
-    if f.is_file():
-        f.unlink()
-    else:
-        shutil.rmtree(f, True)
+    except NotADirectoryError:
+        os.unlink(dirname)
+
+
+def rename_into_trash(dirname):
+    '''rename a directory into the trash, return its new path or None if
+    there is nothing to discard'''
+    trash_path = os.path.join(trashdir, uuid.uuid4().hex)
+    try:
+        os.rename(dirname, trash_path)
+    except FileNotFoundError:
+        if not os.path.lexists(dirname):
+            return None
+        # the trash directory itself is missing, recreate it and retry
+        create_directory(trashdir)
+        os.rename(dirname, trash_path)
+    return trash_path
+
+
+def discard_directory(dirname):
+    '''move a directory to the trash and delete it in the background'''
+    app.logger.info('Discarding directory %s', dirname)
+    try:
+        trash_path = rename_into_trash(dirname)
+    except OSError as ex:
+        # report the failure without raising, the queue discards
+        # directories while picking a task and must not stop on one
+        # that cannot be removed
+        if ex.errno == errno.EXDEV:
+            # trash is not on the same filesystem, delete in place
+            try:
+                remove_directory_recursive(dirname)
+            except OSError:
+                app.logger.exception('Failed to remove %s', dirname)
+        else:
+            app.logger.exception('Failed to discard %s', dirname)
+        return
+    if trash_path is not None:
+        cleanup_executor.submit(shutil.rmtree, trash_path, True)
+
+
+def move_directory_contents(src, dst):
+    '''move the contents of a directory into another, renaming where possible'''
+    with os.scandir(src) as it:
+        for entry in it:
+            # shutil.move renames on the same filesystem and only
+            # falls back to copying across filesystems
+            shutil.move(entry.path, os.path.join(dst, entry.name))
 
 
 def create_directory(dir_path):
     '''create a directory, don't fail if it exists'''
-    app.logger.info('Creating ' + dir_path)
+    app.logger.info('Creating %s', dir_path)
     pathlib.Path(dir_path).mkdir(parents=True, exist_ok=True)
 
 
 def run_build(task, tmpdir, outdir, logpath):
-    '''run a build with parameters from task'''
-    remove_directory_recursive(tmpdir_parent)
+    '''run a build with parameters from task, return True if it succeeded'''
+    # other workers may be building next to it, only clear our own tree
+    discard_directory(tmpdir)
     create_directory(tmpdir)
     tmp_src_dir = os.path.join(tmpdir, 'build_src')
-    source_repo = ap_git.GitRepo.shallow_clone_at_commit_from_local(
-        source=sourcedir,
-        remote=task['remote'],
-        commit_ref=task['git_hash_short'],
-        dest=tmp_src_dir
-    )
+    # the commit may have to be fetched into the shared source checkout,
+    # which other workers and the metadata fetchers also use
+    with repo.get_checkout_lock():
+        source_repo = ap_git.GitRepo.shallow_clone_at_commit_from_local(
+            source=sourcedir,
+            remote=task['remote'],
+            commit_ref=task['git_hash_short'],
+            dest=tmp_src_dir
+        )
+    # the fresh clone is already checked out at the requested commit,
     # update submodules in temporary source directory
-    source_repo.submodule_update(init=True, recursive=True, force=True)
-    # checkout to the commit pointing to the requested commit
-    source_repo.checkout_remote_commit_ref(
-        remote=task['remote'],
-        commit_ref=task['git_hash_short'],
+    source_repo.submodule_update(
+        init=True,
+        recursive=True,
         force=True,
-        hard_reset=True,
-        clean_working_tree=True
+        jobs=os.cpu_count(),
+        depth=1
     )
     if not os.path.isfile(os.path.join(outdir, 'extra_hwdef.dat')):
         app.logger.error('Build aborted, missing extra_hwdef.dat')
     app.logger.info('Appending to build.log')
-    with open(logpath, 'a') as log:
+    # unbuffered, so our status lines go straight to the file in order
+    # with the output of waf, which writes to the same O_APPEND file
+    with open(logpath, 'ab', buffering=0) as log:
 
-        log.write('Setting vehicle to: ' + task['vehicle'].capitalize() + '\n')
-        log.flush()
+        log.write(('Setting vehicle to: ' + task['vehicle'].capitalize() + '\n').encode())
         # setup PATH to point at our compiler
         env = os.environ.copy()
         bindir1 = os.path.abspath(os.path.join(appdir, "..", "bin"))
@@ -136,113 +217,212 @@ def run_build(task, tmpdir, outdir, logpath):
 
         env["PATH"] = bindir1 + ":" + bindir2 + ":" + env["PATH"]
         env['CCACHE_DIR'] = cachedir
+        # every build runs in its own temporary directory, make ccache
+        # hash paths relative to it so identical sources from different
+        # builds hit the same cache entries
+        env['CCACHE_BASEDIR'] = tmpdir
+        env['CCACHE_NOHASHDIR'] = '1'
+        # the sources are freshly checked out for every build
+        env['CCACHE_SLOPPINESS'] = 'time_macros,include_file_mtime,include_file_ctime,pch_defines,file_macro'
 
         app.logger.info('Running waf configure')
-        log.write('Running waf configure\n')
-        log.flush()
-        subprocess.run(['python3', './waf', 'configure',
+        log.write(b'Running waf configure\n')
+        ret = subprocess.run(['python3', './waf', 'configure',
                         '--board', task['board'], 
                         '--out', tmpdir, 
                         '--extra-hwdef', task['extra_hwdef']],
                         cwd = tmp_src_dir,
                         env=env,
+                        stdin=subprocess.DEVNULL,
                         stdout=log, stderr=log, shell=False)
-        app.logger.info('Running clean')
-        log.write('Running clean\n')
-        log.flush()
-        subprocess.run(['python3', './waf', 'clean'],
-                        cwd = tmp_src_dir, 
-                        env=env,
-                        stdout=log, stderr=log, shell=False)
+        if ret.returncode != 0:
+            app.logger.error('waf configure failed')
+            log.write(b'Build failed, waf configure failed\n')
+            return False
+        # no waf clean, the output directory is created fresh for every
+        # build so there is nothing to clean
         app.logger.info('Running build')
-        log.write('Running build\n')
-        log.flush()
-        subprocess.run(['python3', './waf', task['vehicle']],
+        log.write(b'Running build\n')
+        ret = subprocess.run(['python3', './waf', task['vehicle']],
                         cwd = tmp_src_dir,
                         env=env,
+                        stdin=subprocess.DEVNULL,
                         stdout=log, stderr=log, shell=False)
-        log.write('done build\n')
-        log.flush()
+        log.write(b'done build\n')
+        return ret.returncode == 0
 
 def sort_json_files(reverse=False):
-    json_files = list(filter(os.path.isfile,
-                             glob.glob(os.path.join(outdir_parent,
-                                                    '*', 'q.json'))))
-    json_files.sort(key=lambda x: os.path.getmtime(x), reverse=reverse)
-    return json_files
+    # one stat per build directory gives both the existence and the
+    # modification time of its q.json
+    mtimes = {}
+    with os.scandir(outdir_parent) as it:
+        for e in it:
+            if not e.is_dir():
+                continue
+            json_file = os.path.join(e.path, 'q.json')
+            try:
+                mtimes[json_file] = os.stat(json_file).st_mtime
+            except FileNotFoundError:
+                continue
+    return sorted(mtimes, key=mtimes.get, reverse=reverse)
 
 def check_queue():
-    '''thread to continuously run queued builds'''
-    queue_lock.acquire()
-    json_files = sort_json_files()
-    queue_lock.release()
-    if len(json_files) == 0:
-        return
+    '''run the oldest queued build, return False if the queue is empty'''
     # remove multiple build requests from same ip address (keep newest)
-    queue_lock.acquire()
-    ip_list = []
-    for f in json_files:
-        file = json.loads(open(f).read())
-        ip_list.append(file['ip'])
-    seen = set()
-    ip_list.reverse()
-    for index, value in enumerate(ip_list):
-        if value in seen:
-            file = json.loads(open(json_files[-index-1]).read())
-            outdir_to_delete = os.path.join(outdir_parent, file['token'])
-            remove_directory_recursive(outdir_to_delete)
-        else:
-            seen.add(value)
-    queue_lock.release()
-    if len(json_files) == 0:
-        return
-    # open oldest q.json file
-    json_files = sort_json_files()
-    taskfile = json_files[0]
-    app.logger.info('Opening ' + taskfile)
-    task = json.loads(open(taskfile).read())
-    app.logger.info('Removing ' + taskfile)
-    os.remove(taskfile)
+    # json_files is sorted oldest first, so a request replaces any
+    # earlier one from the same ip seen before it in a single pass
+    latest_per_ip = {}
+    with queue_lock:
+        json_files = sort_json_files()
+        for index, f in enumerate(json_files):
+            try:
+                file = json.loads(pathlib.Path(f).read_bytes())
+                ip = file['ip']
+                token = file['token']
+            except FileNotFoundError:
+                # discarded since the queue was listed
+                continue
+            except (ValueError, KeyError, TypeError):
+                # a broken task would otherwise be retried on every pass
+                # and hold up the rest of the queue, fail it instead
+                app.logger.exception('Dropping invalid task %s', f)
+                try:
+                    os.remove(f)
+                    with open(os.path.join(os.path.dirname(f), 'build.log'), 'a') as log:
+                        log.write("\nBuild failed, invalid task\nBUILD_FINISHED\n")
+                except OSError:
+                    # e.g. discarded meanwhile, must not stop the pass
+                    app.logger.exception('Failed to drop %s', f)
+                continue
+            previous = latest_per_ip.get(ip)
+            if previous is not None:
+                # only renamed away while holding the lock, the slow
+                # delete runs in the background
+                discard_directory(os.path.join(outdir_parent, previous[3]))
+            latest_per_ip[ip] = (index, f, file, token)
+        if len(latest_per_ip) == 0:
+            return False
+        # pick the oldest remaining q.json file, it is removed under the
+        # lock so that no other worker picks the same task
+        _, taskfile, task, _ = min(latest_per_ip.values())
+        app.logger.info('Removing %s', taskfile)
+        os.remove(taskfile)
     outdir = os.path.join(outdir_parent, task['token'])
     tmpdir = os.path.join(tmpdir_parent, task['token'])
     logpath = os.path.abspath(os.path.join(outdir, 'build.log'))
-    app.logger.info("LOGPATH: %s" % logpath)
+    app.logger.info("LOGPATH: %s", logpath)
     try:
         # run build and rename build directory
-        app.logger.info('MIR: Running build ' + str(task))
-        run_build(task, tmpdir, outdir, logpath)
-        app.logger.info('Copying build files from %s to %s',
-                        os.path.join(tmpdir, task['board']),
-                            outdir)
-        copy_tree(os.path.join(tmpdir, task['board'], 'bin'), outdir)
-        app.logger.info('Build successful!')
-        remove_directory_recursive(tmpdir)
-
-    except Exception as ex:
-        app.logger.info('Build failed: ', ex)
-        pass
-    open(logpath,'a').write("\nBUILD_FINISHED\n")
-
-def file_age(fname):
-    '''return file age in seconds'''
-    return time.time() - os.stat(fname).st_mtime
+        app.logger.info('MIR: Running build %s', task)
+        if run_build(task, tmpdir, outdir, logpath):
+            bindir = os.path.join(tmpdir, task['board'], 'bin')
+            app.logger.info('Moving build files from %s to %s', bindir, outdir)
+            move_directory_contents(bindir, outdir)
+            app.logger.info('Build successful!')
+        else:
+            # there are no build files to move, the log says why
+            app.logger.info('Build failed')
+
+    except Exception:
+        app.logger.exception('Build failed')
+    finally:
+        # failed builds leave their clone and waf output behind too
+        discard_directory(tmpdir)
+        try:
+            with repo.get_checkout_lock():
+                ap_git.GitRepo.release_shared_clone(
+                    source=sourcedir,
+                    dest=os.path.join(tmpdir, 'build_src')
+                )
+        except Exception:
+            app.logger.exception('Failed to release the clone of %s', tmpdir)
+        with open(logpath, 'a') as log:
+            log.write("\nBUILD_FINISHED\n")
+    return True
 
 def remove_old_builds():
-    '''as a cleanup, remove any builds older than 24H'''
-    for f in os.listdir(outdir_parent):
-        bdir = os.path.join(outdir_parent, f)
-        if os.path.isdir(bdir) and file_age(bdir) > 24 * 60 * 60:
-            remove_directory_recursive(bdir)
-    time.sleep(5)
-
-def queue_thread():
+    '''as a cleanup, remove any builds older than 24H, return the time
+    at which the next build becomes old'''
+    max_age = 24 * 60 * 60
+    now = time.time()
+    # builds created after this scan expire after any build seen now,
+    # so no scan is needed before the oldest remaining build expires
+    next_expiry = now + max_age
+    old_builds = []
+    with os.scandir(outdir_parent) as it:
+        for e in it:
+            if not e.is_dir():
+                continue
+            expiry = e.stat().st_mtime + max_age
+            if expiry < now:
+                old_builds.append(e.path)
+            else:
+                next_expiry = min(next_expiry, expiry)
+    for bdir in old_builds:
+        discard_directory(bdir)
+    return next_expiry
+
+def queue_thread(cleanup):
+    next_cleanup = 0
     while True:
+        # cleared before looking at the queue so that a build queued
+        # while checking still wakes up the wait below
+        queue_event.clear()
+        ran_build = False
         try:
-            check_queue()
-            remove_old_builds()
-        except Exception as ex:
-            app.logger.error('Failed queue: ', ex)
-            pass
+            ran_build = check_queue()
+            if cleanup and time.time() >= next_cleanup:
+                next_cleanup = remove_old_builds()
+        except Exception:
+            app.logger.exception('Failed queue')
+        if not ran_build:
+            queue_event.wait(timeout=5)
+
+def scan_build_log(build_id):
+    '''scan the part of build.log written since the last call and return
+    what has been found in the whole log so far'''
+    log_file_path = os.path.join(outdir_parent,build_id,'build.log')
+    scan = build_log_scans.get(build_id)
+    size = os.path.getsize(log_file_path)
+    if scan is not None and size == scan['offset']:
+        # nothing was written since the last scan
+        return scan
+    if scan is None or size < scan['offset']:
+        # first scan, or the build was started again
+        scan = {
+            'offset': 0,
+            'finished': False,
+            'failed': False,
+            'build_finished': False,
+            'steps': None,
+        }
+        build_log_scans[build_id] = scan
+
+    with open(log_file_path, 'rb') as f:
+        f.seek(scan['offset'])
+        data = f.read()
+    # only consume complete lines so no marker is split between two scans
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        return scan
+    scan['offset'] += end
+    # search the raw bytes, the markers are plain ASCII so nothing needs
+    # to be decoded
+
+    vehicle = build_id.split(':')[0].lower()
+    if data.find(b"'%s' finished successfully" % vehicle.encode(), 0, end) != -1:
+        scan['finished'] = True
+    if data.find(b'The configuration failed', 0, end) != -1 or data.find(b'Build failed', 0, end) != -1 or data.find(b'compilation terminated', 0, end) != -1:
+        scan['failed'] = True
+    if data.find(b'BUILD_FINISHED', 0, end) != -1:
+        scan['build_finished'] = True
+    # only the last step counts, walk the matches without a list of them
+    last_match = None
+    for last_match in progress_regex.finditer(data, 0, end):
+        pass
+    if last_match is not None:
+        scan['steps'] = last_match.groups()[1:]
+    return scan
 
 def get_build_progress(build_id, build_status):
     '''return build progress on scale of 0 to 100'''
@@ -252,16 +432,12 @@ def get_build_progress(build_id, build_status):
     if build_status == 'Finished':
         return 100
     
-    log_file_path = os.path.join(outdir_parent,build_id,'build.log')
-    app.logger.info('Opening ' + log_file_path)
-    build_log = open(log_file_path, encoding='utf-8').read()
-    compiled_regex = re.compile(r'(\[\D*(\d+)\D*\/\D*(\d+)\D*\])')
-    all_matches = compiled_regex.findall(build_log)
+    steps = scan_build_log(build_id)['steps']
 
-    if (len(all_matches) < 1):
+    if steps is None:
         return 0
 
-    completed_steps, total_steps = all_matches[-1][1:]
+    completed_steps, total_steps = steps
     if (int(total_steps) < 20):
         # these steps are just little compilation and linking that happen at initialisation
         # these do not contribute significant percentage to overall build progress
@@ -282,19 +458,18 @@ def get_build_status(build_id):
     if len(build_id_split) < 2:
         raise Exception('Invalid build id')
 
-    if os.path.exists(os.path.join(outdir_parent,build_id,'q.json')):
+    build_dir = os.path.join(outdir_parent,build_id)
+    if os.path.exists(os.path.join(build_dir,'q.json')):
         status = "Pending"
-    elif not os.path.exists(os.path.join(outdir_parent,build_id,'build.log')):
+    elif not os.path.exists(os.path.join(build_dir,'build.log')):
         status = "Error"
     else:
-        log_file_path = os.path.join(outdir_parent,build_id,'build.log')
-        app.logger.info('Opening ' + log_file_path)
-        build_log = open(log_file_path, encoding='utf-8').read()
-        if build_log.find("'%s' finished successfully" % build_id_split[0].lower()) != -1:
+        scan = scan_build_log(build_id)
+        if scan['finished']:
             status = "Finished"
-        elif build_log.find('The configuration failed') != -1 or build_log.find('Build failed') != -1 or build_log.find('compilation terminated') != -1:
+        elif scan['failed']:
             status = "Failed"
-        elif build_log.find('BUILD_FINISHED') == -1:
+        elif not scan['build_finished']:
             status = "Running"
         else:
             status = "Failed"
@@ -302,19 +477,21 @@ def get_build_status(build_id):
 
 def update_build_dict():
     '''update the build_dict dictionary which keeps track of status of all builds'''
-    global builds_dict
-    # get list of directories
-    blist = []
-    for b in os.listdir(outdir_parent):
-        if os.path.isdir(os.path.join(outdir_parent,b)):
-            blist.append(b)
+    global builds_dict, next_age_change
+    # get list of directories along with their modification times,
+    # scandir caches the entry type so only one stat is needed per entry
+    with os.scandir(outdir_parent) as it:
+        mtimes = {e.name: e.stat().st_mtime for e in it if e.is_dir()}
 
     #remove deleted builds from build_dict
-    for build in builds_dict:
-        if build not in blist:
+    for build in list(builds_dict):
+        if build not in mtimes:
             builds_dict.pop(build, None)
+            build_log_scans.pop(build, None)
 
-    for b in blist:
+    now = time.time()
+    next_age_change = float('inf')
+    for b in mtimes:
         build_id_split = b.split(':')
         if len(build_id_split) < 2:
             continue
@@ -325,20 +502,15 @@ def update_build_dict():
             build_info['vehicle'] = build_id_split[0].capitalize()
             build_info['board'] = build_id_split[1]
             feature_file = os.path.join(outdir_parent, b, 'selected_features.json')
-            app.logger.info('Opening ' + feature_file)
-            selected_features_dict = json.loads(open(feature_file).read())
+            app.logger.info('Opening %s', feature_file)
+            selected_features_dict = json.loads(pathlib.Path(feature_file).read_bytes())
             selected_features = selected_features_dict['selected_features']
             build_info['git_hash_short'] = selected_features_dict['git_hash_short']
-            features = ''
-            for feature in selected_features:
-                if features == '':
-                    features = features + feature
-                else:
-                    features = features + ", " + feature
-            build_info['features'] = features
-
-        age_min = int(file_age(os.path.join(outdir_parent,b))/60.0)
+            build_info['features'] = ", ".join(selected_features)
+
+        age_min = int((now - mtimes[b])/60.0)
         build_info['age'] = "%u:%02u" % ((age_min // 60), age_min % 60)
+        next_age_change = min(next_age_change, mtimes[b] + (age_min + 1) * 60)
 
         # refresh build status only if it was pending, running or not initialised
         if (build_info.get('status', None) in ['Pending', 'Running', None]):
@@ -348,24 +520,39 @@ def update_build_dict():
         # update dictionary entry
         builds_dict[b] = build_info
 
-    temp_list = sorted(list(builds_dict.items()), key=lambda x: os.path.getmtime(os.path.join(outdir_parent,x[0])), reverse=True)
+    temp_list = sorted(list(builds_dict.items()), key=lambda x: mtimes[x[0]], reverse=True)
     builds_dict = {ele[0] : ele[1]  for ele in temp_list}
 
 def create_status():
     '''create status.json'''
-    global builds_dict
+    global builds_dict, status_json
     update_build_dict()
+    json_object = json.dumps(builds_dict, separators=(',', ':'))
+    if json_object == status_json:
+        # nothing changed since the last write
+        return
     tmpfile = os.path.join(outdir_parent, "status.tmp")
     statusfile = os.path.join(outdir_parent, "status.json")
-    json_object = json.dumps(builds_dict)
     with open(tmpfile, "w") as outfile:
         outfile.write(json_object)
     os.replace(tmpfile, statusfile)
+    status_json = json_object
 
 def status_thread():
+    last_entries = None
     while True:
         try:
-            create_status()
+            # with no build pending or running, the status can only change
+            # when a build directory is added or removed, or when the age of
+            # a build rolls over to its next minute. the entries are compared
+            # rather than the directory mtime, which every status.json write
+            # changes too
+            active = any(b.get('status') in ['Pending', 'Running']
+                         for b in builds_dict.values())
+            entries = set(os.listdir(outdir_parent))
+            if active or entries != last_entries or time.time() >= next_age_change:
+                create_status()
+                last_entries = entries
         except Exception as ex:
             app.logger.info(ex)
             pass
@@ -377,23 +564,42 @@ if not os.path.isdir(outdir_parent):
     create_directory(outdir_parent)
 
 try:
-    lock_file = open(os.path.join(basedir, "queue.lck"), "w")
+    # the lock is held for as long as this module global keeps the file
+    # open, open it without truncating so the holder's pid is preserved
+    lock_file = open(os.path.join(basedir, "queue.lck"), "a+")
     fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
     app.logger.info("Got queue lock")
-    # we only want one set of threads
-    thread = Thread(target=queue_thread, args=())
-    thread.daemon = True
-    thread.start()
+    # record the pid of the process running the queue
+    lock_file.truncate(0)
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    have_queue_lock = True
+except IOError:
+    app.logger.info("No queue lock")
+    have_queue_lock = False
+
+if have_queue_lock:
+    # empty the trash left over from a previous run
+    create_directory(trashdir)
+    for f in os.listdir(trashdir):
+        cleanup_executor.submit(shutil.rmtree, os.path.join(trashdir, f), True)
+    # and the build trees of builds interrupted by a restart
+    discard_directory(tmpdir_parent)
+    repo.release_all_shared_clones()
+    # we only want one set of threads, one of the build workers also
+    # removes old builds
+    for i in range(build_workers):
+        thread = Thread(target=queue_thread, args=(i == 0,))
+        thread.daemon = True
+        thread.start()
 
     status_thread = Thread(target=status_thread, args=())
     status_thread.daemon = True
     status_thread.start()
-except IOError:
-    app.logger.info("No queue lock")
 
 versions_fetcher.reload_remotes_json()
 
-app.logger.info('Python version is: %s' % sys.version)
+app.logger.info('Python version is: %s', sys.version)
 
 def get_auth_token():
     try:
@@ -451,104 +657,101 @@ def generate():
         )
 
         # fetch features from user input
-        extra_hwdef = []
+        undefs = []
+        defines = []
         feature_list = []
         selected_features = []
         app.logger.info('Fetching features from user input')
 
-        # add all undefs at the start
-        for f in build_options:
-            extra_hwdef.append('undef %s' % f.define)
-
+        # build the undefs and the defines in a single pass,
+        # undefs are placed at the start
         for f in build_options:
-            if f.label not in request.form or request.form[f.label] != '1':
-                extra_hwdef.append('define %s 0' % f.define)
-            else:
-                extra_hwdef.append('define %s 1' % f.define)
+            undefs.append('undef %s' % f.define)
+            if request.form.get(f.label) == '1':
+                defines.append('define %s 1' % f.define)
                 feature_list.append(f.description)
                 selected_features.append(f.label)
+            else:
+                defines.append('define %s 0' % f.define)
 
-        extra_hwdef = '\n'.join(extra_hwdef)
+        extra_hwdef = '\n'.join(undefs + defines)
         spaces = '\n'
         feature_list = spaces.join(feature_list)
         selected_features_dict = {}
         selected_features_dict['selected_features'] = selected_features
 
-        queue_lock.acquire()
-
-        # create extra_hwdef.dat file and obtain md5sum
-        app.logger.info('Creating ' + 
-                        os.path.join(outdir_parent, 'extra_hwdef.dat'))
-        file = open(os.path.join(outdir_parent, 'extra_hwdef.dat'), 'w')
-        app.logger.info('Writing\n' + extra_hwdef)
-        file.write(extra_hwdef)
-        file.close()
-
-        extra_hwdef_md5sum = hashlib.md5(extra_hwdef.encode('utf-8')).hexdigest()
-        app.logger.info('Removing ' +
-                        os.path.join(outdir_parent, 'extra_hwdef.dat'))
-        os.remove(os.path.join(outdir_parent, 'extra_hwdef.dat'))
+        # obtain a 128 bit hash of extra_hwdef, blake2b is faster than md5
+        extra_hwdef_hash = hashlib.blake2b(extra_hwdef.encode('utf-8'), digest_size=16).hexdigest()
 
         new_git_hash = repo.commit_id_for_remote_ref(
             remote=chosen_remote,
             commit_ref=chosen_commit_reference
         )
         git_hash_short = new_git_hash[:10]
-        app.logger.info('Git hash = ' + new_git_hash)
+        app.logger.info('Git hash = %s', new_git_hash)
         selected_features_dict['git_hash_short'] = git_hash_short
 
         # create directories using concatenated token 
-        # of vehicle, board, git-hash of source, and md5sum of hwdef
-        token = chosen_vehicle.lower() + ':' + chosen_board + ':' + new_git_hash + ':' + extra_hwdef_md5sum
-        app.logger.info('token = ' + token)
+        # of vehicle, board, git-hash of source, and hash of hwdef
+        token = chosen_vehicle.lower() + ':' + chosen_board + ':' + new_git_hash + ':' + extra_hwdef_hash
+        app.logger.info('token = %s', token)
         outdir = os.path.join(outdir_parent, token)
 
-        if os.path.isdir(outdir):
-            app.logger.info('Build already exists')
-        else:
-            create_directory(outdir)
-            # create build.log
-            build_log_info = ('Vehicle: ' + chosen_vehicle +
-                '\nBoard: ' + chosen_board +
-                '\nRemote: ' + chosen_remote +
-                '\ngit-sha: ' + git_hash_short +
-                '\nVersion: ' + chosen_version_info.release_type + '-' + chosen_version_info.version_number +
-                '\nSelected Features:\n' + feature_list +
-                '\n\nWaiting for build to start...\n\n')
-            app.logger.info('Creating build.log')
-            build_log = open(os.path.join(outdir, 'build.log'), 'w')
-            build_log.write(build_log_info)
-            build_log.close()
-            # create hwdef.dat
-            app.logger.info('Opening ' + 
-                            os.path.join(outdir, 'extra_hwdef.dat'))
-            file = open(os.path.join(outdir, 'extra_hwdef.dat'),'w')
-            app.logger.info('Writing\n' + extra_hwdef)
-            file.write(extra_hwdef)
-            file.close()
-            # fill dictionary of variables and create json file
-            task = {}
-            task['token'] = token
-            task['remote'] = chosen_remote
-            task['git_hash_short'] = git_hash_short
-            task['version'] = chosen_version_info.release_type + '-' + chosen_version_info.version_number
-            task['extra_hwdef'] = os.path.join(outdir, 'extra_hwdef.dat')
-            task['vehicle'] = chosen_vehicle.lower()
-            task['board'] = chosen_board
-            task['ip'] = request.remote_addr
-            app.logger.info('Opening ' + os.path.join(outdir, 'q.json'))
-            jfile = open(os.path.join(outdir, 'q.json'), 'w')
-            app.logger.info('Writing task file to ' + 
-                            os.path.join(outdir, 'q.json'))
-            jfile.write(json.dumps(task, separators=(',\n', ': ')))
-            jfile.close()
-            # create selected_features.dat for status table
-            feature_file = open(os.path.join(outdir, 'selected_features.json'), 'w')
-            app.logger.info('Writing\n' + os.path.join(outdir, 'selected_features.json'))
-            feature_file.write(json.dumps(selected_features_dict))
-            feature_file.close()
-
-        queue_lock.release()
+        # only the files of the build are written under the lock, so a
+        # failure above cannot leave the lock held
+        with queue_lock:
+            # queue_lock only serializes requests within this process, creating
+            # the directory atomically also stops another process from queueing
+            # the same build
+            try:
+                os.mkdir(outdir)
+                new_build = True
+            except FileExistsError:
+                new_build = False
+
+            if not new_build:
+                app.logger.info('Build already exists')
+            else:
+                app.logger.info('Creating %s', outdir)
+                # create build.log
+                build_log_info = ('Vehicle: ' + chosen_vehicle +
+                    '\nBoard: ' + chosen_board +
+                    '\nRemote: ' + chosen_remote +
+                    '\ngit-sha: ' + git_hash_short +
+                    '\nVersion: ' + chosen_version_info.release_type + '-' + chosen_version_info.version_number +
+                    '\nSelected Features:\n' + feature_list +
+                    '\n\nWaiting for build to start...\n\n')
+                app.logger.info('Creating build.log')
+                pathlib.Path(outdir, 'build.log').write_text(build_log_info)
+                # create hwdef.dat
+                extra_hwdef_path = os.path.join(outdir, 'extra_hwdef.dat')
+                app.logger.info('Opening %s', extra_hwdef_path)
+                app.logger.info('Writing\n%s', extra_hwdef)
+                pathlib.Path(extra_hwdef_path).write_text(extra_hwdef)
+                # fill dictionary of variables and create json file
+                task = {}
+                task['token'] = token
+                task['remote'] = chosen_remote
+                task['git_hash_short'] = git_hash_short
+                task['version'] = chosen_version_info.release_type + '-' + chosen_version_info.version_number
+                task['extra_hwdef'] = extra_hwdef_path
+                task['vehicle'] = chosen_vehicle.lower()
+                task['board'] = chosen_board
+                task['ip'] = request.remote_addr
+                task_path = os.path.join(outdir, 'q.json')
+                app.logger.info('Writing task file to %s', task_path)
+                # written under another name and renamed into place, so
+                # the queue never sees a partly written task
+                task_tmp_path = task_path + '.tmp'
+                pathlib.Path(task_tmp_path).write_text(
+                    json.dumps(task, separators=(',', ':')))
+                os.replace(task_tmp_path, task_path)
+                # create selected_features.dat for status table
+                feature_path = os.path.join(outdir, 'selected_features.json')
+                app.logger.info('Writing\n%s', feature_path)
+                pathlib.Path(feature_path).write_text(
+                    json.dumps(selected_features_dict, separators=(',', ':')))
+                queue_event.set()
 
         base_url = request.url_root
         app.logger.info(base_url)
@@ -565,24 +768,27 @@ def add_build():
     return render_template('add_build.html')
 
 
-def filter_build_options_by_category(build_options, category):
-    return sorted([f for f in build_options if f.category == category], key=lambda x: x.description.lower())
-
-def parse_build_categories(build_options):
-    return sorted(list(set([f.category for f in build_options])))
+def group_build_options_by_category(build_options):
+    '''return a sorted list of (category, options) pairs, options sorted by description'''
+    grouped = {}
+    for f in build_options:
+        grouped.setdefault(f.category, []).append(f)
+    for options in grouped.values():
+        options.sort(key=lambda x: x.description.lower())
+    return sorted(grouped.items())
 
 @app.route('/', defaults={'token': None}, methods=['GET'])
 @app.route('/viewlog/<token>', methods=['GET'])
 def home(token):
     if token:
-        app.logger.info("Showing log for build id " + token)
+        app.logger.info("Showing log for build id %s", token)
     app.logger.info('Rendering index.html')
     return render_template('index.html', token=token)
 
 @app.route("/builds/<path:name>")
 def download_file(name):
-    app.logger.info('Downloading %s' % name)
-    return send_from_directory(os.path.join(basedir,'builds'), name, as_attachment=False)
+    app.logger.info('Downloading %s', name)
+    return send_from_directory(outdir_parent, name, as_attachment=False)
 
 @app.route("/boards_and_features/<string:vehicle_name>/<string:remote_name>/<string:commit_reference>", methods=['GET'])
 def boards_and_features(vehicle_name, remote_name, commit_reference):
@@ -591,24 +797,22 @@ def boards_and_features(vehicle_name, remote_name, commit_reference):
     if not versions_fetcher.is_version_listed(vehicle=vehicle_name, remote=remote_name, commit_ref=commit_reference):
         return "Bad request. Commit reference not allowed to build for the vehicle.", 400
 
-    app.logger.info('Board list and build options requested for %s %s %s' % (vehicle_name, remote_name, commit_reference))
-    # getting board list for the branch
-    with repo.get_checkout_lock():
-        (boards, default_board) = ap_src_metadata_fetcher.get_boards_at_commit(
-            remote=remote_name,
-            commit_ref=commit_reference
-        )
+    app.logger.info('Board list and build options requested for %s %s %s', vehicle_name, remote_name, commit_reference)
+    # getting board list for the branch, the fetcher only takes the
+    # checkout lock when it has to check out the source tree
+    (boards, default_board) = ap_src_metadata_fetcher.get_boards_at_commit(
+        remote=remote_name,
+        commit_ref=commit_reference
+    )
 
-        options = ap_src_metadata_fetcher.get_build_options_at_commit(
-            remote=remote_name,
-            commit_ref=commit_reference
-        )   # this is a list of Feature() objects defined in build_options.py
+    options = ap_src_metadata_fetcher.get_build_options_at_commit(
+        remote=remote_name,
+        commit_ref=commit_reference
+    )   # this is a list of Feature() objects defined in build_options.py
 
-    # parse the set of categories from these objects
-    categories = parse_build_categories(options)
+    # group these objects by category in a single pass
     features = []
-    for category in categories:
-        filtered_options = filter_build_options_by_category(options, category)
+    for category, filtered_options in group_build_options_by_category(options):
         category_options = []   # options belonging to a given category
         for option in filtered_options:
             category_options.append({
@@ -669,7 +873,7 @@ def get_deafults(vehicle_name, remote_name, commit_reference, board_name):
         return "Couldn't find artifacts for requested release/branch/commit on ardupilot server", 404
 
     url_to_features_txt = artifacts_dir + '/' + board_name + '/features.txt'
-    response = requests.get(url_to_features_txt, timeout=30)
+    response = get_http_session().get(url_to_features_txt, timeout=30)
 
     if not response.status_code == 200:
         return ("Could not retrieve features.txt for given vehicle, version and board combination (Status Code: %d, url: %s)" % (response.status_code, url_to_features_txt), response.status_code)
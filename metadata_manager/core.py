@@ -2,9 +2,11 @@ import logging
 import time
 import os
 import fnmatch
+import re
 import ap_git
 import json
 import jsonschema
+from collections import OrderedDict
 from . import exceptions as ex
 from threading import Lock
 from utils import TaskRunner
@@ -19,6 +21,11 @@ class APSourceMetadataFetcher:
     """
 
     __singleton = None
+    # boards matching any of these patterns are not offered for building
+    __excluded_boards_regex = re.compile(
+        '|'.join(fnmatch.translate(p) for p in ['fmuv*', 'SITL*']),
+        re.IGNORECASE
+    )
 
     def __init__(self, ap_repo: ap_git.GitRepo) -> None:
         """
@@ -39,8 +46,46 @@ class APSourceMetadataFetcher:
             raise ex.TooManyInstancesError()
 
         self.repo = ap_repo
+        # results are cached per commit id as the board list and the
+        # build options can only change with the commit
+        self.__cache_size = 32
+        self.__access_lock_cache = Lock()
+        self.__boards_cache = OrderedDict()
+        self.__build_options_cache = OrderedDict()
         APSourceMetadataFetcher.__singleton = self
 
+    def __cache_get(self, cache: OrderedDict, commit_id: str):
+        """
+        Return the cached value for a commit id, None if not cached
+
+        Parameters:
+            cache (OrderedDict): The cache to look into
+            commit_id (str): The commit id the value was cached for
+        """
+        with self.__access_lock_cache:
+            value = cache.get(commit_id)
+            if value is not None:
+                # mark as most recently used
+                cache.move_to_end(commit_id)
+            return value
+
+    def __cache_put(self, cache: OrderedDict, commit_id: str,
+                    value) -> None:
+        """
+        Cache a value for a commit id, evicting the least recently
+        used entry if the cache is full
+
+        Parameters:
+            cache (OrderedDict): The cache to store the value in
+            commit_id (str): The commit id to cache the value for
+            value: The value to cache
+        """
+        with self.__access_lock_cache:
+            cache[commit_id] = value
+            cache.move_to_end(commit_id)
+            if len(cache) > self.__cache_size:
+                cache.popitem(last=False)
+
     def get_boards_at_commit(self, remote: str,
                              commit_ref: str) -> tuple:
         """
@@ -59,11 +104,19 @@ class APSourceMetadataFetcher:
                                        designated as the default.
         """
         tstart = time.time()
+        commit_id = self.repo.commit_id_for_remote_ref(
+            remote=remote,
+            commit_ref=commit_ref
+        )
+        cached = self.__cache_get(self.__boards_cache, commit_id)
+        if cached is not None:
+            return cached
+
         import importlib.util
         with self.repo.get_checkout_lock():
             self.repo.checkout_remote_commit_ref(
                 remote=remote,
-                commit_ref=commit_ref,
+                commit_ref=commit_id,
                 force=True,
                 hard_reset=True,
                 clean_working_tree=True
@@ -78,21 +131,17 @@ class APSourceMetadataFetcher:
             mod = importlib.util.module_from_spec(spec)
             spec.loader.exec_module(mod)
             all_boards = mod.AUTOBUILD_BOARDS
-        exclude_patterns = ['fmuv*', 'SITL*']
-        boards = []
-        for b in all_boards:
-            excluded = False
-            for p in exclude_patterns:
-                if fnmatch.fnmatch(b.lower(), p.lower()):
-                    excluded = True
-                    break
-            if not excluded:
-                boards.append(b)
+        boards = [
+            b for b in all_boards
+            if not self.__excluded_boards_regex.match(b)
+        ]
         logger.debug(
             f"Took {(time.time() - tstart)} seconds to get boards"
         )
         boards.sort()
         default_board = boards[0]
+        self.__cache_put(self.__boards_cache, commit_id,
+                         (boards, default_board))
         return (boards, default_board)
 
     def get_build_options_at_commit(self, remote: str,
@@ -108,11 +157,19 @@ class APSourceMetadataFetcher:
             list: A list of build options available at the specified commit.
         """
         tstart = time.time()
+        commit_id = self.repo.commit_id_for_remote_ref(
+            remote=remote,
+            commit_ref=commit_ref
+        )
+        cached = self.__cache_get(self.__build_options_cache, commit_id)
+        if cached is not None:
+            return cached
+
         import importlib.util
         with self.repo.get_checkout_lock():
             self.repo.checkout_remote_commit_ref(
                 remote=remote,
-                commit_ref=commit_ref,
+                commit_ref=commit_id,
                 force=True,
                 hard_reset=True,
                 clean_working_tree=True
@@ -132,6 +189,8 @@ class APSourceMetadataFetcher:
         logger.debug(
             f"Took {(time.time() - tstart)} seconds to get build options"
         )
+        self.__cache_put(self.__build_options_cache, commit_id,
+                         build_options)
         return build_options
 
     @staticmethod
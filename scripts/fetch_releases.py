@@ -5,6 +5,14 @@ import re
 import requests
 
 IGNORE_VERSIONS_BEFORE = '4.3'
+FIRMWARE_VERSION_EXP = re.compile(
+    r'#define FIRMWARE_VERSION (\d+),(\d+),(\d+),FIRMWARE_VERSION_TYPE_(\w+)',  # noqa
+    re.ASCII
+)
+STABLE_TAG_BODY_EXP = re.compile(r'\d+\.\d+\.\d+', re.ASCII)
+# version.h of every tag is fetched from the same host, keep the
+# connection alive between the requests
+session = requests.Session()
 
 
 def version_number_and_type(git_hash, ap_source_subdir):
@@ -12,7 +20,7 @@ def version_number_and_type(git_hash, ap_source_subdir):
         "https://raw.githubusercontent.com/ArduPilot/ardupilot/"
         f"{git_hash}/{ap_source_subdir}/version.h"
     )
-    response = requests.get(url=url)
+    response = session.get(url=url)
 
     if response.status_code != 200:
         print(response.text)
@@ -22,11 +30,9 @@ def version_number_and_type(git_hash, ap_source_subdir):
             f"Got status code {response.status_code}"
         )
 
-    exp = re.compile(
-        r'#define FIRMWARE_VERSION (\d+),(\d+),(\d+),FIRMWARE_VERSION_TYPE_(\w+)'  # noqa
-    )
-    matches = re.findall(exp, response.text)
-    major, minor, patch, fw_type = matches[0]
+    major, minor, patch, fw_type = FIRMWARE_VERSION_EXP.search(
+        response.text
+    ).groups()
     fw_type = fw_type.lower()
 
     if fw_type == 'official':
@@ -72,6 +78,7 @@ def construct_vehicle_versions_list(vehicle, ap_source_subdir,
                                     fw_server_vehicle_sdir,
                                     tag_filter_exps, tags):
     ret = []
+    tag_filter_exps = [re.compile(exp) for exp in tag_filter_exps]
     for tag_info in tags:
         tag = tag_info['ref'].replace('refs/tags/', '')
 
@@ -80,7 +87,7 @@ def construct_vehicle_versions_list(vehicle, ap_source_subdir,
             # the regexes capture two groups
             # first group is the matched substring itself
             # second group is the tag body (e.g., beta, stable, 4.5.1 etc)
-            matches.extend(re.findall(re.compile(exp), tag))
+            matches.extend(exp.findall(tag))
 
         if matches:
             matched_string, tag_body = matches[0]
@@ -106,7 +113,7 @@ def construct_vehicle_versions_list(vehicle, ap_source_subdir,
                 print(f"{v_num} Version too old. Ignoring.")
                 continue
 
-            if re.search(r'\d+\.\d+\.\d+', tag_body):
+            if STABLE_TAG_BODY_EXP.search(tag_body):
                 # we do stable version tags in this format
                 # e.g. Rover-4.5.1, Copter-4.5.1, where Rover and Copter
                 # are prefixes and 4.5.1 is the tag body
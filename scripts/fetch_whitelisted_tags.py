@@ -29,6 +29,7 @@ import json
 import optparse
 import os
 import requests
+from concurrent.futures import ThreadPoolExecutor
 
 
 # TODO: move this to base/configs/whitelisted_custom_tag_remotes.json
@@ -103,10 +104,18 @@ def construct_versions_map(remotes, vehicles):
         } for remote in remotes
     }
 
+    # the remotes are independent, so query github for all of them at
+    # once instead of waiting for each response in turn
+    with ThreadPoolExecutor(max_workers=max(1, len(remotes))) as executor:
+        futures = {
+            remote: executor.submit(fetch_tags_from_github, remote)
+            for remote in remotes
+        }
+
     for remote in remotes:
         try:
             # fetch tag info for ardupilot repo in the remote from github
-            tag_objs = fetch_tags_from_github(remote)
+            tag_objs = futures[remote].result()
         except Exception as e:
             print(e)
             print("Skipping this remote...")